@@ -1,3 +1,4 @@
+import json
 from typing import List, Union
 
 from loguru import logger
@@ -5,6 +6,11 @@ from pydantic import BaseModel, validator
 
 from songmam.models.webhook.events import *
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class Webhook(BaseModel):
     """An object contains one or more events
@@ -23,6 +29,10 @@ class Webhook(BaseModel):
         ]
     ]
 
+    class Config:
+        # `parse_raw` decodes with orjson when it is installed
+        json_loads = orjson.loads if orjson else json.loads
+
     @validator("object")
     def object_equal_page(cls, v):
         if v != "page":
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
 
-from songmam.models.webhook.events.base import WithTimestamp
+from songmam.models.webhook.events.base import BaseMessaging, WithTimestamp
 
 
 class GamePlay(BaseModel):
@@ -1,14 +1,15 @@
 import asyncio
 import re
+from collections import OrderedDict
+from importlib import import_module
+from inspect import iscoroutine
 
 from fastapi import Header
 from fastapi import Query
 from moshimoshi import moshi
-from parse import parse
-from path import Path
-from typing import Optional, Union, List, Awaitable, Callable
+from typing import Optional, Union, List, Callable, Tuple
 
-from fastapi import FastAPI, Request, APIRouter
+from fastapi import FastAPI, Request, APIRouter, BackgroundTasks
 from fastapi.responses import PlainTextResponse
 from loguru import logger
 from pydantic import ValidationError
@@ -20,10 +21,78 @@ from songmam.models.webhook import Webhook
 from songmam.security import verify_webhook_body
 
 
+# how many payloads `dynamic_import` remembers, the least recently used is dropped first
+DYNAMIC_IMPORT_CACHE_SIZE = 1024
+
+# cached for a payload whose function cannot be imported
+_UNRESOLVED = (None, False)
+
+
+# `\1` style backreference or `(?(1)...)` conditional, group numbers shift once combined
+_NUMBERED_GROUP_REFERENCE = re.compile(r"\\[1-9]|\(\?\(\d")
+
+
+def _can_combine(pattern) -> bool:
+    """
+    Whether a regex keeps its meaning inside the combined alternation.
+    Global inline flags, e.g. `(?i)`, would apply to every other regex too.
+    """
+    return not (
+        pattern.flags & ~re.UNICODE or _NUMBERED_GROUP_REFERENCE.search(pattern.pattern)
+    )
+
+
+def _combine_patterns(keys: List[str]):
+    """
+    Compile all postback regexes into one alternation, each one wrapped in its own group.
+    Return the pattern and a mapping from the group index to the position of its key.
+    """
+    combined = re.compile("|".join(f"(?P<_{i}>{key})" for i, key in enumerate(keys)))
+    positions = {combined.groupindex[f"_{i}"]: i for i in range(len(keys))}
+    return combined, positions
+
+
+async def _gather_and_log(coroutines):
+    """Run coroutines concurrently, a failing one is logged without stopping the others"""
+    for result in await asyncio.gather(*coroutines, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.opt(exception=result).error("Uncaught exception in webhook handler")
+
+
+def _ensure_coroutine_function(func: Callable):
+    if not asyncio.iscoroutinefunction(func):
+        raise TypeError(
+            f"{func!r} must be a coroutine function, defined with `async def`"
+        )
+
+
 class WebhookHandler:
-    verify_token: Optional[str] = None
-    app_secret: Optional[str] = None
-    uncaught_postback_handler: Optional[Callable] = None
+    __slots__ = (
+        "app",
+        "verify_token",
+        "app_secret",
+        "path",
+        "dynamic_import",
+        "match_all_postback_handlers",
+        "uncaught_postback_handler",
+        "_pre_webhook_handlers",
+        "_webhook_handlers",
+        "_post_webhook_handlers",
+        "_quick_reply_callbacks",
+        "_button_callbacks",
+        "_delivered_callbacks",
+        "_quick_reply_patterns",
+        "_button_patterns",
+        "_quick_reply_combined",
+        "_button_combined",
+        "_quick_reply_funcs",
+        "_button_funcs",
+        "_has_quick_reply_handlers",
+        "_has_button_handlers",
+        "_dyn_fn_cache",
+        "_event_escapes",
+        "_dynamic_handlers",
+    )
 
     def __init__(
         self,
@@ -33,15 +102,51 @@ class WebhookHandler:
         app_secret: Optional[str] = None,
         dynamic_import=True,
         verify_token: Optional[str] = None,
-        auto_mark_as_seen: bool = True
+        auto_mark_as_seen: bool = True,
+        match_all_postback_handlers: bool = False,
     ):
-        self._post_webhook_handlers = {}
-        self._pre_webhook_handlers = {}
+        """
+        match_all_postback_handlers: call every postback handler whose regex matches the payload,
+            instead of only the first one registered.
+        """
         self.app = app
-        self.verify_token = verify_token
-        self.app_secret = app_secret
+        self.verify_token: Optional[str] = verify_token
+        self.app_secret: Optional[str] = app_secret
         self.path = path
         self.dynamic_import = dynamic_import
+        self.match_all_postback_handlers = match_all_postback_handlers
+        self.uncaught_postback_handler: Optional[Callable] = None
+
+        # these are set by decorators or the 'set_webhook_handler' method
+        self._pre_webhook_handlers = {}
+        self._webhook_handlers = {}
+        self._post_webhook_handlers = {}
+
+        self._quick_reply_callbacks = {}
+        self._button_callbacks = {}
+        self._delivered_callbacks = {}
+
+        # compiled at registration time, (pattern, callback) pairs
+        self._quick_reply_patterns = []
+        self._button_patterns = []
+
+        # every regex above in a single pattern, the matched group index maps to its callback
+        self._quick_reply_combined = None
+        self._button_combined = None
+        self._quick_reply_funcs = {}
+        self._button_funcs = {}
+        self._has_quick_reply_handlers = False
+        self._has_button_handlers = False
+
+        # payload -> (function imported by `dynamic_import`, is coroutine function)
+        self._dyn_fn_cache = OrderedDict()
+
+        # event type -> method, looked up once per event in `handle_webhook`
+        self._event_escapes = {MessagesEventWithQuickReply: self._escape_quick_reply}
+        self._dynamic_handlers = {
+            MessagesEventWithQuickReply: self._handle_quick_reply_event,
+            PostbackEvent: self._handle_postback_event,
+        }
 
         if self.verify_token:
 
@@ -79,7 +184,9 @@ class WebhookHandler:
 
         @app.post(path)
         async def handle_entry(
-            request: Request, signature: str = Header(..., alias="X-Hub-Signature")
+            request: Request,
+            background_tasks: BackgroundTasks,
+            signature: str = Header(..., alias="X-Hub-Signature"),
         ):
             body = await request.body()
 
@@ -93,90 +200,158 @@ class WebhookHandler:
                     "Without app secret supplied, The server will not be able to identity the integrety of callback."
                 )
 
+            # a body that cannot be parsed still gets 200, or facebook keeps retrying it
             try:
                 webhook = Webhook.parse_raw(body)
-                await self.handle_webhook(webhook, request=request)
-            except ValidationError as e:
+            except ValidationError:
                 logger.error("Cannot parse webhook")
                 logger.error("Body is {}", body)
-            return "ok"
+                return "ok"
 
-    # these are set by decorators or the 'set_webhook_handler' method
-    _webhook_handlers = {}
-
-    _quick_reply_callbacks = {}
-    _button_callbacks = {}
-    _delivered_callbacks = {}
-
-    _quick_reply_callbacks_key_regex = {}
-    _button_callbacks_key_regex = {}
-    _delivered_callbacks_key_regex = {}
+            # respond to facebook right away, handlers run after the response is sent
+            background_tasks.add_task(self.handle_webhook, webhook, request=request)
+            return "ok"
 
     async def handle_webhook(self, webhook: Webhook, *args, **kwargs):
-        for event in webhook.entry:
-            event_type = type(event)
-
-            # quick_replies raw input escape
-            if event_type is MessagesEventWithQuickReply:
-                if event.payload == "#raw_input":
-                    event = event.convert_to_no_reply()
-                    event_type = MessagesEvent
-                elif event.payload.startswith("#input_as"):
-                    the_parsed = parse("#input_as#{text}", event.payload)
-                    event = event.convert_to_no_reply()
-                    event.theMessaging.message.text = the_parsed.text
-                    event_type = MessagesEvent
-
-            # Unconditional handlers
-            handler = self._webhook_handlers.get(event_type)
-            if handler:
-                asyncio.create_task(handler(event, *args, **kwargs))
-            else:
-                if not self.dynamic_import and event_type is PostbackEvent:
-                    logger.warning(
-                        "there's no handler for this event type, {}", str(event_type)
-                    )
-
-            # Dynamic handlers
-            if event_type is MessagesEventWithQuickReply:
-                if self.dynamic_import:
-                    asyncio.create_task(
-                        self.call_dynamic_function(*args, event=event, **kwargs)
-                    )
-                else:
-                    matched_callbacks = self.get_quick_reply_callbacks(event)
-                    for callback in matched_callbacks:
-                        asyncio.create_task(callback(event, *args, **kwargs))
-            elif event_type is PostbackEvent:
-                if self.dynamic_import:
-                    asyncio.create_task(
-                        self.call_dynamic_function(*args, event=event, **kwargs)
-                    )
-                matched_callbacks = self.get_postback_callbacks(event)
-                for callback in matched_callbacks:
-                    asyncio.create_task(callback(event, *args, **kwargs))
+        """
+        Dispatch every event in the webhook concurrently.
+        Handlers of different events are not run in order, guard any shared state they mutate.
+        """
+        await _gather_and_log(
+            self._dispatch_event(event, *args, **kwargs) for event in webhook.entry
+        )
+
+    async def _dispatch_event(self, event, *args, **kwargs):
+        escape = self._event_escapes.get(type(event))
+        if escape:
+            event = escape(event)
+        event_type = type(event)
+        coroutines = []
+
+        # Unconditional handlers
+        handler = self._webhook_handlers.get(event_type)
+        if handler:
+            coroutines.append(handler(event, *args, **kwargs))
+
+        # Dynamic handlers
+        dynamic_handler = self._dynamic_handlers.get(event_type)
+        if dynamic_handler:
+            coroutines.extend(dynamic_handler(event, *args, **kwargs))
+
+        await _gather_and_log(coroutines)
+
+    @staticmethod
+    def _escape_quick_reply(event: MessagesEventWithQuickReply):
+        """quick_replies raw input escape"""
+        if event.payload == "#raw_input":
+            return event.convert_to_no_reply()
+        elif event.payload.startswith("#input_as#"):
+            text = event.payload[len("#input_as#") :]
+            event = event.convert_to_no_reply()
+            event.theMessaging.message.text = text
+        return event
+
+    def _handle_quick_reply_event(
+        self, event: MessagesEventWithQuickReply, *args, **kwargs
+    ):
+        if self.dynamic_import:
+            return [self.call_dynamic_function(*args, event=event, **kwargs)]
+        elif not self._has_quick_reply_handlers:
+            return []
+        else:
+            return [
+                callback(event, *args, **kwargs)
+                for callback in self.get_quick_reply_callbacks(event)
+            ]
+
+    def _handle_postback_event(self, event: PostbackEvent, *args, **kwargs):
+        event_type = type(event)
+        if not self.dynamic_import and event_type not in self._webhook_handlers:
+            logger.warning(
+                "there's no handler for this event type, {}", str(event_type)
+            )
+
+        coroutines = []
+        if self._has_button_handlers:
+            coroutines.extend(
+                callback(event, *args, **kwargs)
+                for callback in self.get_postback_callbacks(event)
+            )
+        if self.dynamic_import:
+            coroutines.append(self.call_dynamic_function(*args, event=event, **kwargs))
+        return coroutines
 
     async def call_dynamic_function(
         self, *args, event: Union[MessagesEventWithQuickReply, PostbackEvent], **kwargs
     ):
         payload = event.payload
         kwargs["event"] = event
-        if self.uncaught_postback_handler:
-            await moshi.moshi(
-                payload, *args, fallback=self.uncaught_postback_handler, **kwargs
-            )
+        cache = self._dyn_fn_cache
+        resolved = cache.get(payload)
+        if resolved is None:
+            resolved = self._import_dynamic_function(payload)
         else:
-            try:
-                await moshi.moshi(payload, *args, **kwargs)
-            except ModuleNotFoundError as e:
-                import os
+            cache.move_to_end(payload)
 
-                logger.debug("This is cwd, {}", os.getcwd())
+        if resolved is None:
+            # not a plain "import_path:function_name", e.g. a json from `moshi.to_json`
+            try:
+                ret = moshi(
+                    payload, *args, fallback=self.uncaught_postback_handler, **kwargs
+                )
+                if iscoroutine(ret):
+                    await ret
+                return
+            except ModuleNotFoundError:
                 logger.exception("Verbose about exception")
+                resolved = _UNRESOLVED
+
+        function, is_coroutine_function = resolved
+        if function is None:
+            if self.uncaught_postback_handler is None:
                 logger.warning(
                     "You could add `uncaught_postback_handler` to caught this '{}' payload",
-                    event.payload,
+                    payload,
                 )
+                return
+            # a public attribute, it might be assigned a sync function directly
+            function, is_coroutine_function = self.uncaught_postback_handler, False
+
+        if is_coroutine_function:
+            await function(*args, **kwargs)
+        else:
+            # e.g. a sync wrapper that returns the coroutine of an `async def`
+            ret = function(*args, **kwargs)
+            if iscoroutine(ret):
+                await ret
+
+    def _import_dynamic_function(self, payload: str) -> Optional[Tuple[Callable, bool]]:
+        """
+        Import the function that "import_path:function_name" payload point to, and cache it
+        together with whether it is a coroutine function.
+        A payload that fails to import is cached as `_UNRESOLVED`, so it is not imported again.
+        Return None if the payload is not in that format.
+        """
+        import_path, sep, function_name = payload.rpartition(":")
+        if not (sep and import_path and function_name.isidentifier()):
+            return None
+
+        try:
+            module = import_module(import_path)
+            function = getattr(module, function_name)
+        except (ImportError, AttributeError, TypeError, ValueError):
+            import os
+
+            logger.debug("This is cwd, {}", os.getcwd())
+            logger.exception("Verbose about exception")
+            resolved = _UNRESOLVED
+        else:
+            resolved = function, asyncio.iscoroutinefunction(function)
+
+        self._dyn_fn_cache[payload] = resolved
+        if len(self._dyn_fn_cache) > DYNAMIC_IMPORT_CACHE_SIZE:
+            self._dyn_fn_cache.popitem(last=False)
+        return resolved
 
     def add_pre(self, entry_type):
         """
@@ -215,6 +390,7 @@ class WebhookHandler:
         #             spaces.append(tuple(con))
 
         def decorator(func):
+            _ensure_coroutine_function(func)
             # for condition in product(*spaces):
             self._webhook_handlers[event_type] = func
 
@@ -249,6 +425,7 @@ class WebhookHandler:
         self, regexes: List[str] = None, quick_reply=True, button=True
     ):
         def wrapper(func):
+            _ensure_coroutine_function(func)
             if regexes is None:
                 return func
 
@@ -258,32 +435,78 @@ class WebhookHandler:
                 if button:
                     self._button_callbacks[payload] = func
 
+            (
+                self._quick_reply_patterns,
+                self._quick_reply_combined,
+                self._quick_reply_funcs,
+            ) = self._compile_callbacks(self._quick_reply_callbacks)
+            (
+                self._button_patterns,
+                self._button_combined,
+                self._button_funcs,
+            ) = self._compile_callbacks(self._button_callbacks)
+            self._has_quick_reply_handlers = bool(self._quick_reply_callbacks)
+            self._has_button_handlers = bool(self._button_callbacks)
+
             return func
 
         return wrapper
 
     def set_uncaught_postback_handler(self, func):
+        _ensure_coroutine_function(func)
         self.uncaught_postback_handler = func
         return func
 
-    def get_quick_reply_callbacks(self, entry: MessagesEvent):
-        callbacks = []
-        for key in self._quick_reply_callbacks.keys():
-            if key not in self._quick_reply_callbacks_key_regex:
-                self._quick_reply_callbacks_key_regex[key] = re.compile(key + "$")
-
-            if self._quick_reply_callbacks_key_regex[key].match(entry.payload):
-                callbacks.append(self._quick_reply_callbacks[key])
+    def _compile_callbacks(self, callbacks: dict):
+        patterns = [(re.compile(key), callback) for key, callback in callbacks.items()]
+        if (
+            not patterns
+            or self.match_all_postback_handlers
+            or not all(_can_combine(pattern) for pattern, _ in patterns)
+        ):
+            return patterns, None, {}
+
+        try:
+            combined, positions = _combine_patterns(list(callbacks.keys()))
+        except re.error:
+            # e.g. two regexes declare the same group name
+            return patterns, None, {}
+
+        funcs = list(callbacks.values())
+        return (
+            patterns,
+            combined,
+            {group: funcs[position] for group, position in positions.items()},
+        )
+
+    def _match_callbacks(self, payload: str, patterns, combined, funcs):
+        if combined is None:
+            callbacks = [
+                callback for pattern, callback in patterns if pattern.fullmatch(payload)
+            ]
+            return callbacks if self.match_all_postback_handlers else callbacks[:1]
+
+        matched = combined.fullmatch(payload)
+        if matched is None:
+            return []
+        return [funcs[matched.lastindex]]
 
-        return callbacks
+    def get_quick_reply_callbacks(self, entry: MessagesEvent):
+        if not self._has_quick_reply_handlers:
+            return []
+        return self._match_callbacks(
+            entry.payload,
+            self._quick_reply_patterns,
+            self._quick_reply_combined,
+            self._quick_reply_funcs,
+        )
 
     def get_postback_callbacks(self, entry: PostbackEvent):
-        callbacks = []
-        for key in self._button_callbacks.keys():
-            if key not in self._button_callbacks_key_regex:
-                self._button_callbacks_key_regex[key] = re.compile(key + "$")
-
-            if self._button_callbacks_key_regex[key].match(entry.payload):
-                callbacks.append(self._button_callbacks[key])
-
-        return callbacks
+        if not self._has_button_handlers:
+            return []
+        return self._match_callbacks(
+            entry.payload,
+            self._button_patterns,
+            self._button_combined,
+            self._button_funcs,
+        )
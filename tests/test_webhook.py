@@ -0,0 +1,305 @@
+import functools
+import json
+import sys
+from types import ModuleType, SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import songmam.webhook
+from songmam.models.webhook.events import MessagesEvent, PostbackEvent
+from songmam.webhook import WebhookHandler
+
+HEADERS = {"X-Hub-Signature": "sha1=" + "0" * 40}
+
+
+def messaging_entry(**messaging):
+    return {
+        "id": "PAGE_ID",
+        "time": 1458692752478,
+        "messaging": [
+            {
+                "sender": {"id": "PSID"},
+                "recipient": {"id": "PAGE_ID"},
+                "timestamp": 1458692752478,
+                **messaging,
+            }
+        ],
+    }
+
+
+def postback_body(*payloads):
+    return {
+        "object": "page",
+        "entry": [
+            messaging_entry(postback={"title": "button", "payload": payload})
+            for payload in payloads
+        ],
+    }
+
+
+def quick_reply_body(payload, text="hello"):
+    return {
+        "object": "page",
+        "entry": [
+            messaging_entry(
+                message={
+                    "mid": "mid.1457764197618:41d102a3e1ae206a38",
+                    "text": text,
+                    "quick_reply": {"payload": payload},
+                }
+            )
+        ],
+    }
+
+
+def post(client, body):
+    return client.post("/webhook", data=json.dumps(body), headers=HEADERS)
+
+
+@pytest.fixture
+def app():
+    return FastAPI()
+
+
+@pytest.fixture
+def client(app):
+    return TestClient(app)
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def handlers_module(monkeypatch, calls):
+    """A module for `dynamic_import` payloads like "dyn_handlers:tell" """
+    module = ModuleType("dyn_handlers")
+
+    async def tell(*args, event, **kwargs):
+        calls.append(("tell", event.payload))
+
+    module.tell = tell
+    monkeypatch.setitem(sys.modules, "dyn_handlers", module)
+    return module
+
+
+@pytest.fixture
+def imports(monkeypatch):
+    """Import paths passed to `import_module` by the webhook"""
+    imported = []
+    import_module = songmam.webhook.import_module
+
+    def counting_import_module(name):
+        imported.append(name)
+        return import_module(name)
+
+    monkeypatch.setattr(songmam.webhook, "import_module", counting_import_module)
+    return imported
+
+
+def recorder(calls, name):
+    async def handler(event, *args, **kwargs):
+        calls.append((name, event.payload))
+
+    return handler
+
+
+def test_postback_calls_first_matched_handler(app, client, calls):
+    handler = WebhookHandler(app, dynamic_import=False)
+    handler.add_postback_handler(["menu.*"])(recorder(calls, "menu"))
+    handler.add_postback_handler(["menu 2"])(recorder(calls, "menu 2"))
+
+    response = post(client, postback_body("menu 2", "other"))
+
+    assert handler._button_combined is not None
+    assert response.status_code == 200
+    assert calls == [("menu", "menu 2")]
+
+
+def test_postback_calls_all_matched_handlers(app, client, calls):
+    handler = WebhookHandler(
+        app, dynamic_import=False, match_all_postback_handlers=True
+    )
+    handler.add_postback_handler(["menu.*"])(recorder(calls, "menu"))
+    handler.add_postback_handler(["menu 2"])(recorder(calls, "menu 2"))
+
+    post(client, postback_body("menu 2"))
+
+    assert sorted(calls) == [("menu", "menu 2"), ("menu 2", "menu 2")]
+
+
+def test_postback_regex_must_match_whole_payload(app, client, calls):
+    handler = WebhookHandler(app, dynamic_import=False)
+    handler.add_postback_handler(["menu"])(recorder(calls, "menu"))
+
+    post(client, postback_body("menu 2"))
+
+    assert calls == []
+
+
+def test_quick_reply_handler(app, client, calls):
+    handler = WebhookHandler(app, dynamic_import=False)
+    handler.add_postback_handler(["size_.*"], button=False)(recorder(calls, "size"))
+
+    post(client, quick_reply_body("size_large"))
+    post(client, postback_body("size_large"))
+
+    assert calls == [("size", "size_large")]
+
+
+@pytest.mark.parametrize(
+    "keys, payload, expected",
+    [
+        ([r"x", r"(\w)\1"], "aa", r"(\w)\1"),
+        ([r"(?i)abc", r"def"], "ABC", r"(?i)abc"),
+        ([r"(?i)abc", r"def"], "DEF", None),
+        ([r"(?P<n>a)b", r"(?P<n>c)d"], "cd", r"(?P<n>c)d"),
+    ],
+)
+def test_postback_regexes_that_cannot_be_combined(app, keys, payload, expected):
+    handler = WebhookHandler(app, dynamic_import=False)
+    callbacks = {}
+    for key in keys:
+        callbacks[key] = handler.add_postback_handler([key])(recorder([], key))
+
+    matched = handler.get_postback_callbacks(SimpleNamespace(payload=payload))
+
+    assert handler._button_combined is None
+    assert matched == ([callbacks[expected]] if expected else [])
+
+
+def test_dynamic_import_is_cached(app, client, calls, handlers_module, imports):
+    WebhookHandler(app)
+
+    post(client, postback_body("dyn_handlers:tell"))
+    post(client, quick_reply_body("dyn_handlers:tell"))
+
+    assert calls == [("tell", "dyn_handlers:tell")] * 2
+    assert imports == ["dyn_handlers"]
+
+
+def test_dynamic_import_json_payload(app, client, calls, handlers_module):
+    WebhookHandler(app)
+    payload = json.dumps({"call": "dyn_handlers:tell"})
+
+    post(client, postback_body(payload))
+
+    assert calls == [("tell", payload)]
+
+
+@pytest.mark.parametrize(
+    "payload", ["missing_module:tell", "dyn_handlers:missing", ".relative:tell"]
+)
+def test_unresolved_payload_is_cached(
+    app, client, calls, handlers_module, imports, payload
+):
+    handler = WebhookHandler(app)
+    handler.set_uncaught_postback_handler(recorder(calls, "uncaught"))
+
+    post(client, postback_body(payload, payload))
+
+    assert calls == [("uncaught", payload)] * 2
+    assert len(imports) == 1
+    assert handler._dyn_fn_cache[payload] == songmam.webhook._UNRESOLVED
+
+
+def test_dynamic_import_cache_drops_least_recently_used(
+    app, client, handlers_module, monkeypatch
+):
+    monkeypatch.setattr(songmam.webhook, "DYNAMIC_IMPORT_CACHE_SIZE", 2)
+    handler = WebhookHandler(app)
+    handlers_module.other = handlers_module.another = handlers_module.tell
+
+    post(client, postback_body("dyn_handlers:tell"))
+    post(client, postback_body("dyn_handlers:other"))
+    post(client, postback_body("dyn_handlers:tell"))
+    post(client, postback_body("dyn_handlers:another"))
+
+    assert list(handler._dyn_fn_cache) == ["dyn_handlers:tell", "dyn_handlers:another"]
+
+
+@pytest.mark.parametrize(
+    "payload, text", [("#raw_input", "hello"), ("#input_as#typed text", "typed text")]
+)
+def test_quick_reply_escape_to_messages_event(app, client, calls, payload, text):
+    handler = WebhookHandler(app, dynamic_import=False)
+    handler.add_postback_handler([".*"])(recorder(calls, "postback"))
+
+    @handler.add(MessagesEvent)
+    async def echo(event, *args, **kwargs):
+        calls.append(("message", event.theMessaging.message.text))
+
+    post(client, quick_reply_body(payload))
+
+    assert calls == [("message", text)]
+
+
+def test_sync_handler_is_rejected(app):
+    handler = WebhookHandler(app)
+
+    def sync_handler(event, *args, **kwargs):
+        pass
+
+    with pytest.raises(TypeError):
+        handler.add(MessagesEvent)(sync_handler)
+    with pytest.raises(TypeError):
+        handler.add_postback_handler(["menu"])(sync_handler)
+    with pytest.raises(TypeError):
+        handler.set_uncaught_postback_handler(sync_handler)
+
+
+def test_sync_function_returning_coroutine_is_awaited(
+    app, client, calls, handlers_module
+):
+    handler = WebhookHandler(app)
+
+    @functools.wraps(handlers_module.tell)
+    def wrapped(*args, **kwargs):
+        return handlers_module.tell(*args, **kwargs)
+
+    handlers_module.wrapped = wrapped
+    handler.uncaught_postback_handler = wrapped
+
+    post(client, postback_body("dyn_handlers:wrapped", "missing_module:tell"))
+
+    assert sorted(calls) == [
+        ("tell", "dyn_handlers:wrapped"),
+        ("tell", "missing_module:tell"),
+    ]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        {
+            "object": "page",
+            "entry": [messaging_entry(reaction={"mid": "mid", "action": "react"})],
+        },
+        {"object": "user", "entry": []},
+    ],
+)
+def test_unparsable_webhook_is_acknowledged(app, client, body):
+    WebhookHandler(app)
+
+    response = post(client, body)
+
+    assert response.status_code == 200
+    assert response.json() == "ok"
+
+
+def test_failing_handler_does_not_stop_other_events(app, client, calls):
+    handler = WebhookHandler(app, dynamic_import=False)
+
+    @handler.add(PostbackEvent)
+    async def fail_on_bad(event, *args, **kwargs):
+        if event.payload == "bad":
+            raise RuntimeError("boom")
+        calls.append(("postback", event.payload))
+
+    response = post(client, postback_body("bad", "good"))
+
+    assert response.status_code == 200
+    assert calls == [("postback", "good")]